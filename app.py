@@ -1,19 +1,69 @@
 from fastapi import FastAPI, Request
 from pydantic import BaseModel
+import asyncio
 import json
-import pickle
+from collections import OrderedDict
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from knowledge_graph import call_gemma, find_most_relevant_contract, RESULTS_JSON, EMBEDDINGS_PKL
+from knowledge_graph import HTTPX_CLIENT, call_gemma, content_hash, load_embedding_model, load_embeddings, load_index, gpu_available, embed_query, search_contracts, RESULTS_JSON
 
 app = FastAPI()
 
 # Load contracts and embeddings at startup
 with open(RESULTS_JSON, "r", encoding="utf-8") as f:
     contracts = json.load(f)
-with open(EMBEDDINGS_PKL, "rb") as f:
-    embeddings = pickle.load(f)
-model = SentenceTransformer('all-MiniLM-L6-v2')
+# Embeddings only exist for contracts that came back with a summary
+contracts = [c for c in contracts if "summary" in c]
+model = load_embedding_model()
+embeddings = load_embeddings(contracts, model)
+index = load_index(embeddings)
+# Contracts never change while serving, so serialize each prompt prefix once
+prompt_prefixes = [
+    f"Given the following contract information:\n{json.dumps(c, indent=2)}\n\nAnswer this question: "
+    for c in contracts
+]
+
+class QueryBatcher:
+    # Coalesces concurrent /ask lookups arriving within a short window into one index.search call,
+    # so a GPU index pays one host-to-device copy per batch instead of per query. A single worker
+    # runs batches back to back (GPU indexes are not thread-safe); queries arriving while a batch
+    # is in flight are collected into the next one.
+    def __init__(self, index, window=0.008, max_batch=64):
+        self.index = index
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = []
+        self.worker = None
+
+    async def search(self, query_emb):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((query_emb, future))
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self._drain())
+        return await future
+
+    async def _drain(self):
+        await asyncio.sleep(self.window)
+        while self.pending:
+            batch = self.pending[:self.max_batch]
+            del self.pending[:self.max_batch]
+            queries = np.vstack([query_emb for query_emb, _ in batch])
+            try:
+                scores, ids = await asyncio.to_thread(self.index.search, queries, 1)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for i, (_, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result((int(ids[i, 0]), scores[i, 0]))
+
+# Batching only pays off for GPU indexes; CPU lookups go straight to the index
+batcher = QueryBatcher(index) if gpu_available() else None
+
+# Gemma answers keyed by (contract file_id, query hash), least recently used evicted first
+ANSWER_CACHE_SIZE = 2048
+answer_cache = OrderedDict()
 
 class AskRequest(BaseModel):
     query: str
@@ -21,12 +71,28 @@ class AskRequest(BaseModel):
 @app.post("/ask")
 async def ask(request: AskRequest):
     query = request.query
-    contract, score = find_most_relevant_contract(query, contracts, embeddings, model)
-    context = json.dumps(contract, indent=2)
-    prompt = f"Given the following contract information:\n{context}\n\nAnswer this question: {query}"
-    response = call_gemma(prompt)
+    # Encoding is CPU-bound; keep it off the event loop
+    if batcher is not None:
+        query_emb = await asyncio.to_thread(embed_query, model, query)
+        idx, score = await batcher.search(query_emb)
+    else:
+        idx, score = await asyncio.to_thread(search_contracts, query, index, model)
+    contract = contracts[idx]
+    key = (contract["file_id"], content_hash(query))
+    if key in answer_cache:
+        answer_cache.move_to_end(key)
+        response = answer_cache[key]
+    else:
+        response = await call_gemma(prompt_prefixes[idx] + query)
+        answer_cache[key] = response
+        if len(answer_cache) > ANSWER_CACHE_SIZE:
+            answer_cache.popitem(last=False)
     return {"answer": response, "contract": contract, "score": float(score)}
 
+@app.on_event("shutdown")
+async def close_http_client():
+    await HTTPX_CLIENT.aclose()
+
 @app.get("/")
 def root():
     return {"message": "Contract Knowledge Graph API. Use POST /ask with {'query': 'your question'}"} 
\ No newline at end of file
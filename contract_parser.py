@@ -3,7 +3,7 @@ Knowledge Graph Contract Extractor & CLI
 
 Instructions:
 1. Install dependencies:
-   pip install sentence-transformers chromadb pypdf tiktoken isodate matplotlib seaborn tqdm pydantic requests
+   pip install model2vec chromadb pypdf tiktoken isodate matplotlib seaborn tqdm pydantic requests
 2. Start your Gemma proxy (or set GEMMA_URL to your Cloud Run endpoint).
 3. Place your contract .txt files in a folder, e.g., ./contracts/
 4. Run this script:
@@ -21,15 +21,17 @@ from pydantic import BaseModel, Field
 from tqdm import tqdm
 import isodate
 import requests
-from sentence_transformers import SentenceTransformer
+import numpy as np
+from model2vec import StaticModel
 
 # ========== CONFIG =============
 CONTRACTS_FOLDER = './contracts'  # Change this to your contracts folder
 OUTPUT_FOLDER = './output'
 RESULTS_JSON = os.path.join(OUTPUT_FOLDER, 'contract_data.json')
-EMBEDDINGS_PKL = os.path.join(OUTPUT_FOLDER, 'embedding_outputs.pkl')
+EMBEDDINGS_NPY = os.path.join(OUTPUT_FOLDER, 'embeddings.npy')
 GEMMA_URL = os.environ.get('GEMMA_URL', 'http://localhost:9090/api/generate')
 GEMMA_MODEL = os.environ.get('GEMMA_MODEL', 'gemma3:1b')
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'minishlab/potion-base-8M')
 
 # ========== DATA MODELS =============
 CLAUSE_TYPES = [
@@ -116,6 +118,10 @@ def add_duration_to_date(date_str, duration_str):
     result_date = date_obj + duration
     return result_date.strftime("%Y-%m-%d")
 
+def load_embedding_model():
+    # Static token embeddings: a lookup plus mean pooling, no transformer forward pass
+    return StaticModel.from_pretrained(EMBEDDING_MODEL, normalize=True)
+
 # ========== GEMMA CALL =============
 def call_gemma(prompt: str, model: str = GEMMA_MODEL, url: str = GEMMA_URL, temperature: float = 0.7) -> str:
     payload = {
@@ -207,12 +213,14 @@ def parse():
     with open(RESULTS_JSON, "w", encoding="utf-8") as json_file:
         json.dump(results, json_file, indent=2)
     print(f"\nStructured contract data saved to {RESULTS_JSON}")
-    print("\nGenerating embeddings with sentence-transformers...")
-    model = SentenceTransformer('all-MiniLM-L6-v2')
+    print("\nGenerating embeddings with model2vec...")
+    model = load_embedding_model()
     summaries = [el["summary"] for el in results if "summary" in el]
-    embeddings_output = model.encode(summaries)
-    import pickle as pkl
-    with open(EMBEDDINGS_PKL, 'wb') as f:
-        pkl.dump(embeddings_output, f)
-    print(f"Embeddings saved to {EMBEDDINGS_PKL}")
+    embeddings_output = model.encode(summaries, show_progress_bar=True)
+    # Replace atomically; the API memory-maps this file
+    tmp_path = f"{EMBEDDINGS_NPY}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, embeddings_output)
+    os.replace(tmp_path, EMBEDDINGS_NPY)
+    print(f"Embeddings saved to {EMBEDDINGS_NPY}")
     print("\nEntering interactive prompt mode. Type 'quit' to exit.")
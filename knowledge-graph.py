@@ -3,35 +3,52 @@ Knowledge Graph Contract Extractor & CLI
 
 Instructions:
 1. Install dependencies:
-   pip install sentence-transformers chromadb pypdf tiktoken isodate matplotlib seaborn tqdm pydantic requests
+   pip install model2vec chromadb pypdf tiktoken isodate matplotlib seaborn tqdm pydantic pandas "httpx[http2]"
 2. Start your Gemma proxy (or set GEMMA_URL to your Cloud Run endpoint).
 3. Place your contract .txt files in a folder, e.g., ./contracts/
 4. Run this script:
    python knowledge-graph.py
+   (or `python knowledge-graph.py --embed-only` to only re-embed the saved results in ./output/)
 
 Outputs will be saved in ./output/
 """
 
 import os
+import sys
 import json
 import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime
 from typing import List, Optional
 from pydantic import BaseModel, Field
-from tqdm import tqdm
+from tqdm.asyncio import tqdm
 import isodate
-import requests
-from sentence_transformers import SentenceTransformer
-import pickle
+import httpx
+from model2vec import StaticModel
 import numpy as np
+import pandas as pd
+try:
+    import faiss
+except ImportError:  # Fall back to a NumPy/BLAS scan
+    faiss = None
 
 # ========== CONFIG =============
 CONTRACTS_FOLDER = './contracts'  # Change this to your contracts folder
 OUTPUT_FOLDER = './output'
 RESULTS_JSON = os.path.join(OUTPUT_FOLDER, 'contract_data.json')
-EMBEDDINGS_PKL = os.path.join(OUTPUT_FOLDER, 'embedding_outputs.pkl')
+EMBEDDINGS_NPY = os.path.join(OUTPUT_FOLDER, 'embeddings.npy')
+FAISS_INDEX = os.path.join(OUTPUT_FOLDER, 'faiss.index')
+FAISS_INDEX_META = FAISS_INDEX + '.json'  # Which embeddings/settings the saved index was built from
+EXTRACT_CACHE_DIR = os.path.join(OUTPUT_FOLDER, 'extract_cache')
 GEMMA_URL = os.environ.get('GEMMA_URL', 'http://localhost:9090/api/generate')
 GEMMA_MODEL = os.environ.get('GEMMA_MODEL', 'gemma3:1b')
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'minishlab/potion-base-8M')
+GEMMA_TIMEOUT = float(os.environ.get('GEMMA_TIMEOUT', '300'))
+HNSW_THRESHOLD = 50000  # Switch from exact to HNSW search above this many contracts
+QUANTIZE_EMBEDDINGS = os.environ.get('QUANTIZE_EMBEDDINGS', '0') == '1'  # Store index vectors as 8-bit codes (approximate scores)
+USE_GPU = os.environ.get('USE_GPU', '1') == '1'  # Serve the index from GPU(s) when FAISS sees any
 
 # ========== DATA MODELS =============
 CLAUSE_TYPES = [
@@ -92,56 +109,64 @@ class Contract(BaseModel):
     clauses: Optional[List[Clause]] = Field(None, description=f"""Relevant summaries of clause types. Allowed clause types are {CLAUSE_TYPES}""")
 
 # ========== UTILS =============
-def read_txt_files(folder_path):
-    data = []
+def _read_txt_file(entry):
+    with open(entry.path, "r", encoding="utf-8") as file:
+        return {"file_id": os.path.splitext(entry.name)[0], "text": file.read()}
+
+def read_txt_files(folder_path, max_workers=32):
     if not os.path.exists(folder_path):
         raise FileNotFoundError(f"Folder '{folder_path}' not found. Please create it and add .txt contract files.")
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".txt"):
-            file_id = os.path.splitext(filename)[0]
-            file_path = os.path.join(folder_path, filename)
-            with open(file_path, "r", encoding="utf-8") as file:
-                text = file.read()
-                data.append({"file_id": file_id, "text": text})
-    return data
-
-def is_valid_date(date_string):
-    try:
-        datetime.strptime(date_string, '%Y-%m-%d')
-        return True
-    except:
-        return False
+    with os.scandir(folder_path) as it:
+        entries = [entry for entry in it if entry.name.endswith(".txt") and entry.is_file()]
+    # Reads are I/O-bound, so overlapping them in threads hides disk/network latency
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_read_txt_file, entries))
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8")).hexdigest()
+
+@lru_cache(maxsize=None)
+def _parse_duration(duration_str):
+    # Extracted durations repeat a lot (P1Y, P2Y, ...); parse each distinct string once
+    return isodate.parse_duration(duration_str)
 
 def add_duration_to_date(date_str, duration_str):
     date_obj = datetime.strptime(date_str, "%Y-%m-%d")
-    duration = isodate.parse_duration(duration_str)
+    duration = _parse_duration(duration_str)
     result_date = date_obj + duration
     return result_date.strftime("%Y-%m-%d")
 
+def load_embedding_model():
+    # Static token embeddings: a lookup plus mean pooling, no transformer forward pass
+    return StaticModel.from_pretrained(EMBEDDING_MODEL, normalize=True)
+
 # ========== GEMMA CALL =============
-def call_gemma(prompt: str, model: str = GEMMA_MODEL, url: str = GEMMA_URL, temperature: float = 0.7) -> str:
+# Shared client so concurrent calls reuse pooled keep-alive connections (one TLS handshake per
+# connection, not per call); the transport retries failed connection attempts
+HTTPX_CLIENT = httpx.AsyncClient(
+    timeout=httpx.Timeout(GEMMA_TIMEOUT, connect=10.0),
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        retries=3,
+    ),
+)
+
+async def call_gemma(prompt: str, model: str = GEMMA_MODEL, url: str = GEMMA_URL, temperature: float = 0.7) -> str:
     payload = {
         "model": model,
         "prompt": prompt,
+        "stream": False,
         "temperature": temperature
     }
-    response = requests.post(url, json=payload, stream=True)
-    if not response.ok:
+    # Callers only use the final text, so ask for one JSON body instead of streamed lines
+    response = await HTTPX_CLIENT.post(url, json=payload)
+    if not response.is_success:
         raise RuntimeError(f"Gemma API error: {response.status_code} {response.text}")
-    # Gemma streams JSON lines; concatenate 'response' fields
-    result = ""
-    for line in response.iter_lines():
-        if line:
-            try:
-                data = json.loads(line.decode())
-                if 'response' in data:
-                    result += data['response']
-            except Exception:
-                continue
-    return result.strip()
+    return response.json().get('response', '').strip()
 
 # ========== MAIN PROCESSING =============
-def extract_contract_structured(text: str) -> dict:
+async def _extract_with_gemma(text: str) -> dict:
     # Prompt Gemma to extract contract info as JSON
     prompt = f"""
 Extract the following structured information from this contract. Return your answer as a JSON object with these fields:
@@ -161,7 +186,11 @@ Contract text:
 
 Return only the JSON object, no explanation.
 """
-    response = call_gemma(prompt)
+    try:
+        response = await call_gemma(prompt)
+    except (httpx.HTTPError, RuntimeError) as e:
+        # One slow or failed call shouldn't abort the whole run; errors aren't cached, so it's retried next time
+        return {"error": f"Gemma request failed: {e!r}", "raw": None}
     try:
         # Try to parse the first JSON object in the response
         json_start = response.find('{')
@@ -173,85 +202,268 @@ Return only the JSON object, no explanation.
     except Exception as e:
         return {"error": f"Failed to parse JSON: {e}", "raw": response}
 
-def process_contract(contract, semaphore):
-    with semaphore:
-        structured_data = extract_contract_structured(contract["text"])
+async def extract_contract_structured(text: str) -> dict:
+    # Reuse earlier extractions of identical contract text; only new or edited files hit Gemma
+    cache_path = os.path.join(EXTRACT_CACHE_DIR, f"{content_hash(GEMMA_MODEL + text)}.json")
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            pass  # Unreadable entry; treat as a miss and overwrite it below
+    structured_data = await _extract_with_gemma(text)
+    if "error" not in structured_data:
+        os.makedirs(EXTRACT_CACHE_DIR, exist_ok=True)
+        # Write to a temp file and rename so an interrupted run never leaves a truncated entry
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(structured_data, f)
+        os.replace(tmp_path, cache_path)
+    return structured_data
+
+async def process_contract(contract, semaphore):
+    async with semaphore:
+        structured_data = await extract_contract_structured(contract["text"])
         structured_data["file_id"] = contract["file_id"]
-        # Clean dates
-        if "effective_date" in structured_data:
-            structured_data["effective_date"] = structured_data["effective_date"] if is_valid_date(structured_data["effective_date"]) else None
-        if "end_date" in structured_data:
-            structured_data["end_date"] = structured_data["end_date"] if is_valid_date(structured_data["end_date"]) else None
-        # Infer end date
+        return structured_data
+
+def _is_valid_date(date_string):
+    try:
+        datetime.strptime(date_string, '%Y-%m-%d')
+        return True
+    except (TypeError, ValueError):
+        return False
+
+def clean_dates(results):
+    # Validate each date field across all contracts in one vectorized pass
+    for field in ("effective_date", "end_date"):
+        rows = [r for r in results if field in r]
+        if not rows:
+            continue
+        values = pd.Series([r[field] for r in rows], dtype=object)
+        parsed = pd.to_datetime(values, format='%Y-%m-%d', errors='coerce')
+        for row, valid in zip(rows, parsed.notna()):
+            # pandas < 3 can't represent dates past 2262-04-11 (e.g. 9999-12-31), so re-check
+            # NaT values with strptime before discarding them
+            if not valid and not _is_valid_date(row[field]):
+                row[field] = None
+    # Infer end date
+    for structured_data in results:
         if not structured_data.get("end_date") and structured_data.get("effective_date") and structured_data.get("duration"):
             try:
                 structured_data["end_date"] = add_duration_to_date(structured_data["effective_date"], structured_data["duration"])
             except:
                 pass
-        return structured_data
-
-def process_all(contracts, max_workers=5):
-    from threading import Semaphore
-    semaphore = Semaphore(max_workers)
-    results = []
-    for contract in tqdm(contracts, desc="Processing contracts"):
-        results.append(process_contract(contract, semaphore))
     return results
 
-def find_most_relevant_contract(query, contracts, embeddings, model):
-    query_emb = model.encode([query])[0]
-    similarities = np.dot(embeddings, query_emb) / (
-        np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query_emb) + 1e-8
-    )
-    idx = int(np.argmax(similarities))
-    return contracts[idx], similarities[idx]
+async def process_all(contracts, max_workers=8):
+    # The semaphore bounds how many Gemma calls are in flight at once
+    semaphore = asyncio.Semaphore(max_workers)
+    tasks = [process_contract(contract, semaphore) for contract in contracts]
+    results = await tqdm.gather(*tasks, desc="Processing contracts")
+    return clean_dates(results)
+
+class NumpyIndex:
+    # Exact inner-product search with the same search() interface as a FAISS index.
+    # One matrix product per call dispatches to BLAS instead of per-contract dot products.
+    def __init__(self, vectors):
+        self.vectors = vectors
+        self.ntotal = len(vectors)
+
+    def search(self, queries, k):
+        scores = queries @ self.vectors.T
+        k = min(k, self.ntotal)
+        ids = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, ids, axis=1), axis=1)
+        ids = np.take_along_axis(ids, order, axis=1)
+        return np.take_along_axis(scores, ids, axis=1), ids
+
+def build_index(embeddings):
+    # Inner product over L2-normalized vectors is cosine similarity
+    vectors = np.array(embeddings, dtype='float32')
+    if faiss is None:
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-8
+        return NumpyIndex(vectors)
+    faiss.normalize_L2(vectors)
+    dim = vectors.shape[1]
+    # Optional 8-bit scalar quantization stores 1 byte per dimension instead of 4; codes are
+    # decoded to float when scoring, so it saves memory for large corpora rather than compute
+    if len(vectors) > HNSW_THRESHOLD:
+        if QUANTIZE_EMBEDDINGS:
+            index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, 32, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efSearch = 64
+    elif QUANTIZE_EMBEDDINGS:
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    else:
+        index = faiss.IndexFlatIP(dim)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return index
+
+def _index_fingerprint(embeddings):
+    # Ties a saved index to the exact vectors and quantization setting it was built from,
+    # so embeddings rewritten by any script (with the same shape or not) invalidate it
+    digest = hashlib.blake2b(np.ascontiguousarray(embeddings, dtype='float32').tobytes()).hexdigest()
+    return {"embeddings": digest, "quantized": QUANTIZE_EMBEDDINGS}
+
+def _replace_atomically(path, write):
+    # Serving processes memory-map these files; write a sibling temp file and rename it over the
+    # target so they keep a valid mapping instead of seeing the file truncated underneath them
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+def save_index(index, embeddings):
+    if faiss is not None:
+        def write_meta(path):
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(_index_fingerprint(embeddings), f)
+        _replace_atomically(FAISS_INDEX, lambda path: faiss.write_index(index, path))
+        _replace_atomically(FAISS_INDEX_META, write_meta)
+    else:
+        # Don't leave an index from an earlier run next to freshly written embeddings
+        for path in (FAISS_INDEX, FAISS_INDEX_META):
+            if os.path.exists(path):
+                os.remove(path)
+
+def _read_index(path):
+    # IO_FLAG_MMAP only maps IVF inverted lists; FAISS >= 1.10 can also map flat/SQ codes in place
+    # (IO_FLAG_MMAP_IFC) so worker processes share those pages. Otherwise the file is read into memory.
+    mmap_flag = getattr(faiss, 'IO_FLAG_MMAP_IFC', None)
+    if mmap_flag is not None:
+        try:
+            return faiss.read_index(path, mmap_flag)
+        except RuntimeError:
+            pass
+    return faiss.read_index(path)
+
+def gpu_available():
+    return faiss is not None and USE_GPU and faiss.get_num_gpus() > 0
+
+def build_gpu_index(embeddings):
+    # Exact flat search is the GPU fast path; HNSW and scalar-quantized indexes don't transfer
+    vectors = np.array(embeddings, dtype='float32')
+    faiss.normalize_L2(vectors)
+    index = faiss.IndexFlatIP(vectors.shape[1])
+    index.add(vectors)
+    return faiss.index_cpu_to_all_gpus(index)
+
+def load_index(embeddings):
+    if gpu_available():
+        return build_gpu_index(embeddings)
+    # Reuse the prebuilt index only if it was built from these exact embeddings and settings
+    if faiss is not None and os.path.exists(FAISS_INDEX) and os.path.exists(FAISS_INDEX_META):
+        try:
+            with open(FAISS_INDEX_META, "r", encoding="utf-8") as f:
+                fingerprint = json.load(f)
+        except json.JSONDecodeError:
+            fingerprint = None
+        if fingerprint == _index_fingerprint(embeddings):
+            return _read_index(FAISS_INDEX)
+    return build_index(embeddings)
+
+def save_embeddings(model, summaries):
+    embeddings_output = model.encode(summaries, show_progress_bar=True)
+    def write_embeddings(path):
+        with open(path, "wb") as f:
+            np.save(f, embeddings_output)
+    _replace_atomically(EMBEDDINGS_NPY, write_embeddings)
+    print(f"Embeddings saved to {EMBEDDINGS_NPY}")
+    save_index(build_index(embeddings_output), embeddings_output)
+    return embeddings_output
+
+def load_embeddings(contracts, model, rebuild=False):
+    # With rebuild=True, re-embed the stored summaries (no Gemma call) when the file is missing or
+    # from another model; servers leave it False so concurrent workers never race to regenerate
+    if os.path.exists(EMBEDDINGS_NPY):
+        embeddings = np.load(EMBEDDINGS_NPY, mmap_mode='r')
+        if embeddings.shape == (len(contracts), model.dim):
+            return embeddings
+    if not rebuild:
+        raise RuntimeError(
+            f"{EMBEDDINGS_NPY} is missing or was not built with {EMBEDDING_MODEL}; "
+            "run `python knowledge-graph.py --embed-only` to re-embed the saved contract summaries"
+        )
+    print(f"{EMBEDDINGS_NPY} is missing or stale; re-embedding contract summaries with {EMBEDDING_MODEL}...")
+    return save_embeddings(model, [c["summary"] for c in contracts])
+
+def embed_only():
+    # Rebuild embeddings and the index from the saved extractions without calling Gemma
+    with open(RESULTS_JSON, "r", encoding="utf-8") as f:
+        results = json.load(f)
+    summaries = [el["summary"] for el in results if "summary" in el]
+    save_embeddings(load_embedding_model(), summaries)
+
+@lru_cache(maxsize=4096)
+def embed_query(model, query):
+    # Repeat queries skip the encoder entirely
+    return model.encode([query]).astype('float32')
+
+def search_contracts(query, index, model):
+    query_emb = embed_query(model, query)
+    scores, ids = index.search(query_emb, 1)
+    return int(ids[0, 0]), scores[0, 0]
+
+def find_most_relevant_contract(query, contracts, index, model):
+    idx, score = search_contracts(query, index, model)
+    return contracts[idx], score
 
 # ========== MAIN SCRIPT =============
-def main():
+async def main():
     os.makedirs(OUTPUT_FOLDER, exist_ok=True)
     print(f"Reading contracts from: {CONTRACTS_FOLDER}")
     contracts = read_txt_files(CONTRACTS_FOLDER)
     print(f"Found {len(contracts)} contracts.")
     print("\nProcessing contracts with Gemma (this may take a while)...")
-    results = process_all(contracts)
+    results = await process_all(contracts)
     with open(RESULTS_JSON, "w", encoding="utf-8") as json_file:
         json.dump(results, json_file, indent=2)
     print(f"\nStructured contract data saved to {RESULTS_JSON}")
-    print("\nGenerating embeddings with sentence-transformers...")
-    model = SentenceTransformer('all-MiniLM-L6-v2')
+    print("\nGenerating embeddings with model2vec...")
+    model = load_embedding_model()
     summaries = [el["summary"] for el in results if "summary" in el]
-    embeddings_output = model.encode(summaries)
-    with open(EMBEDDINGS_PKL, 'wb') as f:
-        pickle.dump(embeddings_output, f)
-    print(f"Embeddings saved to {EMBEDDINGS_PKL}")
+    embeddings_output = save_embeddings(model, summaries)
     return results, embeddings_output, model
 
-if __name__ == "__main__":
-    contracts, embeddings, model = main()
+async def interactive():
+    contracts, embeddings, model = await main()
 
     # Load contracts and embeddings for retrieval-augmented Q&A
     try:
         with open(RESULTS_JSON, "r", encoding="utf-8") as f:
             contracts = json.load(f)
-        with open(EMBEDDINGS_PKL, "rb") as f:
-            embeddings = pickle.load(f)
-        model = SentenceTransformer('all-MiniLM-L6-v2')
+        # Embeddings only exist for contracts that came back with a summary
+        contracts = [c for c in contracts if "summary" in c]
+        model = load_embedding_model()
+        embeddings = load_embeddings(contracts, model, rebuild=True)
+        index = load_index(embeddings)
     except Exception as e:
         print(f"[Error] Could not load contracts or embeddings: {e}")
-        contracts, embeddings, model = None, None, None
+        contracts, index, model = None, None, None
 
-    while contracts is not None and embeddings is not None and model is not None:
+    while contracts is not None and index is not None and model is not None:
         query = input("\nPrompt: ").strip()
         if query.lower() == 'quit':
             print("Exiting.")
             break
-        contract, score = find_most_relevant_contract(query, contracts, embeddings, model)
+        contract, score = find_most_relevant_contract(query, contracts, index, model)
         context = json.dumps(contract, indent=2)
         prompt = f"Given the following contract information:\n{context}\n\nAnswer this question: {query}"
         try:
-            response = call_gemma(prompt)
+            response = await call_gemma(prompt)
             print(f"Gemma: {response}")
         except Exception as e:
             print(f"[Error] Failed to get response from Gemma: {e}")
+    await HTTPX_CLIENT.aclose()
+
+if __name__ == "__main__":
+    if "--embed-only" in sys.argv:
+        embed_only()
+    else:
+        # Run everything on one event loop so the pooled HTTP client stays valid
+        asyncio.run(interactive())
 
 
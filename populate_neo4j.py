@@ -1,6 +1,7 @@
 from neo4j import GraphDatabase
 
-driver = GraphDatabase.driver("neo4j+s://<your-neo4j-host>", auth=("neo4j", "<password>"))
+driver = GraphDatabase.driver("neo4j+s://<your-neo4j-host>", auth=("neo4j", "<password>"), max_connection_pool_size=50)
+BATCH_SIZE = 10000
 
 def upload_node_with_embedding(tx, name, embedding):
     tx.run("""
@@ -9,4 +10,16 @@ def upload_node_with_embedding(tx, name, embedding):
 
 def upload_embedding(name, embedding):
     with driver.session() as session:
-        session.write_transaction(upload_node_with_embedding, "My Item", embedding)
+        session.execute_write(upload_node_with_embedding, name, embedding)
+
+def upload_nodes_with_embeddings(tx, rows):
+    tx.run("""
+        UNWIND $rows AS row
+        CREATE (n:Item {name: row.name, embedding: row.embedding})
+    """, rows=rows)
+
+def upload_embeddings(rows):
+    # rows: list of {"name": ..., "embedding": [...]}; one transaction per batch instead of per node
+    with driver.session() as session:
+        for start in range(0, len(rows), BATCH_SIZE):
+            session.execute_write(upload_nodes_with_embeddings, rows[start:start + BATCH_SIZE])